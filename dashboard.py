@@ -1,8 +1,21 @@
 # Import necessary libraries
+import contextlib
+import hashlib
+import os
+import tempfile
+import time
+from functools import lru_cache, partial
+from pathlib import Path
+from urllib.request import urlopen
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pac
 import plotly.express as px
 import plotly.graph_objects as go
 import panel as pn
+import requests
 from flask import Flask, jsonify, request
 from pymongo import MongoClient
 from bson.json_util import dumps
@@ -18,37 +31,126 @@ collection = db['equities_data']  # Collection name
 # Initialize Panel extension for Plotly and Tabulator
 pn.extension('plotly', 'tabulator')
 
+# Server options: compress the session websocket frames. The dashboard is started from
+# inside a Flask request, where extra worker processes (num_procs) cannot be forked.
+SERVE_OPTIONS = {"websocket_compression_level": 6}
+
 # Define constants and configurations for the application
 ACCENT = "#BB2649"  # Accent color for the application
 RED = "#D94467"  # Red color for sell actions
 GREEN = "#5AD534"  # Green color for buy actions
 CSV_URL = "https://datasets.holoviz.org/equities/v1/equities.csv"  # URL to fetch equity data
 
-# Dictionary of equity tickers and their corresponding company names
-EQUITIES = {
-    "AAPL": "Apple",
-    "MSFT": "Microsoft",
-    "AMZN": "Amazon",
-    "GOOGL": "Alphabet",
-    "TSLA": "Tesla",
-    "BRK-B": "Berkshire Hathaway",
-    "UNH": "United Health Group",
-    "JNJ": "Johnson & Johnson",
-}
-EQUITY_LIST = tuple(EQUITIES.keys())  # List of equity tickers
+# SVG for external link icon
+LINK_SVG = """
+<svg xmlns="http://www.w3.org/2000/svg" width="16" height="16" fill="currentColor" class="bi bi-arrow-up-right-square" viewBox="0 0 16 16">
+  <path fill-rule="evenodd" d="M15 2a1 1 0 0 0-1-1H2a1 1 0 0 0-1 1v12a1 1 0 0 0 1 1h12a1 1 0 0 0 1-1V2zM0 2a2 2 0 0 1 2-2h12a2 2 0 0 1 2 2v12a2 2 0 0 1-2 2H2a2 2 0 0 1-2-2V2zm5.854 8.803a.5.5 0 1 1-.708-.707L9.243 6H6.475a.5.5 0 1 1 0-1h3.975a.5.5 0 0 1 .5.5v3.975a.5.5 0 1 1-1 0V6.707l-4.096 4.096z"/>
+</svg>
+"""
+
+# Portfolio holdings as a record array, one contiguous array per field
+EQUITIES_ARR = np.rec.fromrecords(
+    [
+        ("AAPL", "Apple", 75, "buy"),
+        ("MSFT", "Microsoft", 40, "sell"),
+        ("AMZN", "Amazon", 100, "hold"),
+        ("GOOGL", "Alphabet", 50, "hold"),
+        ("TSLA", "Tesla", 40, "hold"),
+        ("BRK-B", "Berkshire Hathaway", 60, "hold"),
+        ("UNH", "United Health Group", 20, "hold"),
+        ("JNJ", "Johnson & Johnson", 40, "hold"),
+    ],
+    names="ticker,company,quantity,action",
+)
+EQUITY_LIST = tuple(EQUITIES_ARR.ticker.tolist())  # List of equity tickers
+
+# Yahoo Finance link of each ticker, built once and shared by every table
+INFO_HTML = tuple(
+    f"<a href='https://finance.yahoo.com/quote/{ticker}' target='_blank'>"
+    f"<div title='Open in Yahoo'>{LINK_SVG}</div></a>"
+    for ticker in EQUITY_LIST
+)
+
+# Local Parquet copy of the CSV, keyed by its URL and reused across restarts until older than the TTL
+CACHE_KEY = hashlib.sha1(CSV_URL.encode()).hexdigest()[:16]
+CACHE_PATH = Path.home() / ".panel_equities" / f"equities-{CACHE_KEY}.parquet"
+CACHE_TTL = 24 * 60 * 60  # Time-to-live of the disk cache in seconds
+
+# Function to read the Parquet cache, returning None if it is missing, expired or unreadable
+def read_cached_data(path=CACHE_PATH):
+    try:
+        if time.time() - path.stat().st_mtime >= CACHE_TTL:
+            return None
+        return pd.read_parquet(path, engine="pyarrow")
+    except (OSError, ValueError, pa.ArrowException):
+        return None
+
+# Function to write the Parquet cache atomically, skipping the disk tier on failure
+def write_cached_data(df, path=CACHE_PATH):
+    tmp_path = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write next to the target and swap it in, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        os.close(fd)
+        df.to_parquet(tmp_path, engine="pyarrow", compression="zstd")
+        os.replace(tmp_path, path)
+    except (OSError, pa.ArrowException):
+        if tmp_path is not None:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
 
 # Cache function to get historical data with a time-to-live of 600 seconds
 @pn.cache(ttl=600)
 def get_historical_data(tickers=EQUITY_LIST, period="2y"):
-    df = pd.read_csv(CSV_URL, index_col=[0, 1], parse_dates=['Date'])
+    df = read_cached_data()
+    if df is not None:
+        return df
+    # Parse the CSV with Arrow's multithreaded reader, then index by ticker and date
+    with urlopen(CSV_URL) as response:
+        table = pac.read_csv(
+            response,
+            convert_options=pac.ConvertOptions(column_types={"Date": pa.timestamp("ns")}),
+        )
+    df = table.to_pandas()
+    df = df.set_index(list(df.columns[:2]))
+    write_cached_data(df)
     return df
 
 # Fetch historical data
 historical_data = get_historical_data()
 
+# Last closing price of every ticker, computed in a single pass over the data
+LAST_CLOSE = historical_data["Close"].groupby(level=0).last()
+
+MAX_CANDLES = 1000  # Upper bound on the number of candles sent to the browser
+
+# Function to merge consecutive rows into at most n_out candles, keeping the wick extremes
+def downsample_ohlc(data, n_out=MAX_CANDLES):
+    if len(data) <= n_out:
+        return data
+    buckets = np.arange(len(data)) * n_out // len(data)
+    return data.groupby(buckets).agg(
+        {"Date": "first", "Open": "first", "High": "max", "Low": "min", "Close": "last"}
+    )
+
+# Prices are shipped to the browser as float32, which is plenty of precision for display
+OHLC_DTYPES = {column: "float32" for column in ("Open", "High", "Low", "Close")}
+
+# Function to downcast and downsample the OHLC rows of a single ticker
+def prepare_ticker(frame):
+    return downsample_ohlc(frame.droplevel(0).reset_index().astype(OHLC_DTYPES))
+
+# Per-ticker OHLC frames, split off in one groupby pass so plotting does not hit the MultiIndex again
+TICKER_FRAMES = {
+    ticker: prepare_ticker(frame)
+    for ticker, frame in historical_data.groupby(level=0)
+    if ticker in EQUITY_LIST
+}
+
 # Function to get the last closing price for a given ticker
-def last_close(ticker, data=historical_data):
-    return data.loc[ticker]["Close"].iloc[-1]
+def last_close(ticker, last_closes=LAST_CLOSE):
+    return last_closes[ticker]
 
 # Function to fetch data from MongoDB
 def get_data_from_mongodb():
@@ -60,35 +162,26 @@ def store_data_to_mongodb(data):
     collection.delete_many({})
     collection.insert_many(data.to_dict('records'))
 
-# Prepare the summary data for the equities
-summary_data_dict = {
-    "ticker": EQUITY_LIST,
-    "company": list(EQUITIES.values()),
-    "info": [
-        f"""<a href='https://finance.yahoo.com/quote/{ticker}' target='_blank'>
-        <div title='Open in Yahoo'>
-        <svg xmlns="http://www.w3.org/2000/svg" width="16" height="16" fill="currentColor" class="bi bi-arrow-up-right-square" viewBox="0 0 16 16">
-          <path fill-rule="evenodd" d="M15 2a1 1 0 0 0-1-1H2a1 1 0 0 0-1 1v12a1 1 0 0 0 1 1h12a1 1 0 0 0 1-1V2zM0 2a2 2 0 0 1 2-2h12a2 2 0 0 1 2 2v12a2 2 0 0 1-2 2H2a2 2 0 0 1-2-2V2zm5.854 8.803a.5.5 0 1 1-.708-.707L9.243 6H6.475a.5.5 0 1 1 0-1h3.975a.5.5 0 0 1 .5.5v3.975a.5.5 0 1 1-1 0V6.707l-4.096 4.096z"/>
-        </svg>
-        </div></a>"""
-        for ticker in EQUITIES
-    ],
-    "quantity": [75, 40, 100, 50, 40, 60, 20, 40],
-    "price": [last_close(ticker) for ticker in EQUITIES],
-    "value": None,
-    "action": ["buy", "sell", "hold", "hold", "hold", "hold", "hold", "hold"],
-    "notes": ["" for _ in range(8)],
-}
-
-# Convert the summary data dictionary to a DataFrame
-summary_data = pd.DataFrame(summary_data_dict)
+# Prepare the summary data from the holdings, adding the derived columns as vector operations
+summary_data = pd.DataFrame.from_records(EQUITIES_ARR)
+summary_data.insert(2, "info", INFO_HTML)
+summary_data.insert(4, "price", LAST_CLOSE.reindex(EQUITIES_ARR.ticker).to_numpy())
+summary_data["notes"] = ""
 
 # Function to calculate the market value of each equity
 def get_value_series(data=summary_data):
-    return data["quantity"] * data["price"]
+    return data["quantity"].to_numpy() * data["price"].to_numpy()
 
 # Calculate the value column in the summary data
-summary_data["value"] = get_value_series()
+summary_data.insert(5, "value", get_value_series())
+
+# Price and value columns as NumPy arrays, for positional access on the edit path
+PRICE_ARR = summary_data["price"].to_numpy()
+VALUE_ARR = summary_data["value"].to_numpy(copy=True)  # Kept in sync by handle_cell_edit
+
+# Column positions for scalar .iat lookups of the selected row
+TICKER_COL = summary_data.columns.get_loc("ticker")
+COMPANY_COL = summary_data.columns.get_loc("company")
 
 # Store the initial summary data to MongoDB
 store_data_to_mongodb(summary_data)
@@ -129,6 +222,12 @@ formatters = {
     "price": {"type": "money", "decimal": ".", "thousand": ",", "precision": 2},
     "value": {"type": "money", "decimal": ".", "thousand": ",", "precision": 0},
     "info": {"type": "html", "field": "html"},
+    "action": {
+        "type": "lookup",
+        "buy": "<span class='action-buy'>buy</span>",
+        "sell": "<span class='action-sell'>sell</span>",
+        "hold": "hold",
+    },
 }
 text_align = {
     "price": "right",
@@ -140,6 +239,13 @@ base_configuration = {
     "clipboard": "copy"  # Enable copying data to clipboard
 }
 
+# Cell styles, matched by CSS selectors instead of being computed per cell in Python
+table_stylesheet = f"""
+.action-buy {{ color: {GREEN}; }}
+.action-sell {{ color: {RED}; }}
+.tabulator-cell[tabulator-field="quantity"] {{ background-color: #444; }}
+"""
+
 # Create the summary table widget using Panel's Tabulator
 summary_table = pn.widgets.Tabulator(
     summary_data,
@@ -153,34 +259,61 @@ summary_table = pn.widgets.Tabulator(
     titles=titles,
     widths=widths,
     configuration=base_configuration,
-)
-
-# Define the style function for the action cell
-def style_of_action_cell(value, colors={'buy': GREEN, 'sell': RED}):
-    return f'color: {colors[value]}' if value in colors else ''
-
-# Apply the styles to the summary table
-summary_table.style.map(style_of_action_cell, subset=["action"]).set_properties(
-    **{"background-color": "#444"}, subset=["quantity"]
+    stylesheets=[table_stylesheet],
 )
 
 # IntInput widget to track patches
 patches = pn.widgets.IntInput(description="Used to raise an event when a cell value has changed")
 
-# Function to handle cell edits
+EDIT_DEBOUNCE_MS = 300  # Quiet period before pending edits are applied to the table
+# Pending edits and scheduled flushes are tracked per session document, since timeout
+# callbacks belong to the document that scheduled them
+pending_values = {}  # Document -> {row: new market value} waiting for the next flush
+flush_callbacks = {}  # Document -> timeout callback of its scheduled flush, or None
+
+# Function to apply the pending value edits of a session in one patch and raise a single event
+def flush_pending_values(doc=None, table=summary_table):
+    flush_callbacks[doc] = None
+    values = pending_values.pop(doc, None)
+    if not values:
+        return
+    table.patch({"value": list(values.items())})
+    patches.value += 1
+
+# Function to apply the pending edits of a closing session instead of dropping them
+def flush_closed_session(doc, session_context):
+    flush_pending_values(doc)
+    flush_callbacks.pop(doc, None)
+
+# Function to handle cell edits, debounced per session so fast typing triggers one redraw
 def handle_cell_edit(event, table=summary_table):
     row = event.row
     column = event.column
     if column == "quantity":
-        quantity = event.value
-        price = summary_table.value.loc[row, "price"]
-        value = quantity * price
-        table.patch({"value": [(row, value)]})
-        patches.value += 1
+        VALUE_ARR[row] = event.value * PRICE_ARR[row]
+
+        doc = pn.state.curdoc
+        if doc is not None and doc not in flush_callbacks:
+            doc.on_session_destroyed(partial(flush_closed_session, doc))
+        pending_values.setdefault(doc, {})[row] = VALUE_ARR[row]
+        if doc is None:
+            flush_pending_values(doc, table)
+            return
+        callback = flush_callbacks.get(doc)
+        if callback is not None:
+            # The flush may already have run or been removed with its session
+            with contextlib.suppress(ValueError):
+                doc.remove_timeout_callback(callback)
+        flush_callbacks[doc] = doc.add_timeout_callback(
+            partial(flush_pending_values, doc), EDIT_DEBOUNCE_MS
+        )
 
 # Bind the cell edit event to the handle_cell_edit function
 summary_table.on_edit(handle_cell_edit)
 
+# Layout shared by all candlestick figures
+DARK_LAYOUT = {"template": "plotly_dark", "autosize": True}
+
 # Function to generate candlestick plot
 def candlestick(selection=[], data=summary_data):
     if not selection:
@@ -188,11 +321,16 @@ def candlestick(selection=[], data=summary_data):
         company = "Apple"
     else:
         index = selection[0]
-        ticker = data.loc[index, "ticker"]
-        company = data.loc[index, "company"]
+        ticker = data.iat[index, TICKER_COL]
+        company = data.iat[index, COMPANY_COL]
 
-    dff_ticker_hist = historical_data.loc[ticker].reset_index()
-    dff_ticker_hist["Date"] = pd.to_datetime(dff_ticker_hist["Date"])
+    # Copy the cached figure, since the linked Plotly pane writes zoom and pan state back into it
+    return go.Figure(ticker_figure(ticker, company))
+
+# Function to build the candlestick figure of a ticker, cached so each ticker is built once
+@lru_cache(maxsize=len(EQUITY_LIST))
+def ticker_figure(ticker, company):
+    dff_ticker_hist = TICKER_FRAMES[ticker]
 
     fig = go.Figure(
         go.Candlestick(
@@ -203,11 +341,7 @@ def candlestick(selection=[], data=summary_data):
             close=dff_ticker_hist["Close"],
         )
     )
-    fig.update_layout(
-        title_text=f"{ticker} {company} Daily Price",
-        template="plotly_dark",
-        autosize=True,
-    )
+    fig.update_layout(title_text=f"{ticker} {company} Daily Price", **DARK_LAYOUT)
     return fig
 
 # Function to generate portfolio distribution plot
@@ -226,20 +360,52 @@ def portfolio_distribution(patches=0):
     fig.layout.autosize = True
     return fig
 
-# Bind the candlestick and portfolio_distribution functions to be reactive
+# Portfolio distribution figure, built once and updated in place after edits
+pie_fig = portfolio_distribution()
+pie_pane = pn.pane.Plotly(pie_fig)
+
+# Function to update the portfolio distribution plot in place when a value has changed
+def update_portfolio_distribution(event):
+    portfolio_total = VALUE_ARR.sum()
+    # The pane is linked to the figure, so a batched update reaches it as one message
+    with pie_fig.batch_update():
+        pie_fig.update_traces(values=VALUE_ARR)
+        pie_fig.update_layout(title_text=f"Portfolio Total $ {portfolio_total:,.0f}")
+
+patches.param.watch(update_portfolio_distribution, "value")
+
+# Bind the candlestick function to be reactive
 candlestick = pn.bind(candlestick, selection=summary_table.param.selection)
-portfolio_distribution = pn.bind(portfolio_distribution, patches=patches)
 
-# Create the dashboard layout
+# Function to save data to MongoDB from the Panel dashboard
+def save_data():
+    url = "http://localhost:5000/update_data"
+    headers = {'Content-Type': 'application/json'}
+    data = summary_table.value.to_json(orient='records')
+    response = requests.post(url, headers=headers, data=data)
+    if response.status_code == 200:
+        print("Data saved successfully.")
+    else:
+        print("Error saving data.")
+
+# Add the save button to the Panel dashboard
+save_button = pn.widgets.Button(name='Save Data', button_type='primary')
+save_button.on_click(lambda event: save_data())
+
+# Create the dashboard layout, including the save button
 dashboard = pn.Column(
     pn.Row(
         pn.pane.Plotly(candlestick), 
-        pn.pane.Plotly(portfolio_distribution)
+        pie_pane
     ),
     summary_table,
+    save_button,
     height=600
 )
 
+# Make the dashboard servable
+dashboard.servable()
+
 # Flask API endpoint to get data from MongoDB
 @app.route('/get_data', methods=['GET'])
 def get_data():
@@ -257,39 +423,8 @@ def update_data():
 # Function to serve the Panel dashboard
 @app.route('/dashboard')
 def serve_dashboard():
-    return dashboard.show(port=5006, open=False)
+    return dashboard.show(port=5006, open=False, **SERVE_OPTIONS)
 
 # Run Flask app
 if __name__ == "__main__":
     app.run(port=5000, debug=True)
-
-# Function to save data to MongoDB from the Panel dashboard
-import requests
-
-def save_data():
-    url = "http://localhost:5000/update_data"
-    headers = {'Content-Type': 'application/json'}
-    data = summary_table.value.to_json(orient='records')
-    response = requests.post(url, headers=headers, data=data)
-    if response.status_code == 200:
-        print("Data saved successfully.")
-    else:
-        print("Error saving data.")
-
-# Add the save button to the Panel dashboard
-save_button = pn.widgets.Button(name='Save Data', button_type='primary')
-save_button.on_click(lambda event: save_data())
-
-# Update the dashboard layout to include the save button
-dashboard = pn.Column(
-    pn.Row(
-        pn.pane.Plotly(candlestick), 
-        pn.pane.Plotly(portfolio_distribution)
-    ),
-    summary_table,
-    save_button,
-    height=600
-)
-
-# Make the dashboard servable
-dashboard.servable()
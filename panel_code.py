@@ -1,5 +1,17 @@
 #import libraries
+import contextlib
+import hashlib
+import os
+import tempfile
+import time
+from functools import lru_cache, partial
+from pathlib import Path
+from urllib.request import urlopen
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pac
 import plotly.express as px
 import plotly.graph_objects as go
 
@@ -8,6 +20,14 @@ import panel as pn
 # Initialize Panel with Plotly and Tabulator extensions
 pn.extension('plotly', 'tabulator')
 
+# Server options: compress the session websocket frames. Serving from several processes is
+# opt-in through EQUITIES_NUM_PROCS, since each process holds its own copy of the portfolio
+# state and forking is not supported on Windows
+SERVE_OPTIONS = {
+    "websocket_compression_level": 6,
+    "num_procs": int(os.environ.get("EQUITIES_NUM_PROCS", "1")),
+}
+
 # Define color constants
 ACCENT = "#BB2649"
 RED = "#D94467"
@@ -23,62 +43,130 @@ LINK_SVG = """
 # URL to fetch equity data
 CSV_URL = "https://datasets.holoviz.org/equities/v1/equities.csv"
 
-# Dictionary of equity tickers and their corresponding company names
-EQUITIES = {
-    "AAPL": "Apple",
-    "MSFT": "Microsoft",
-    "AMZN": "Amazon",
-    "GOOGL": "Alphabet",
-    "TSLA": "Tesla",
-    "BRK-B": "Berkshire Hathaway",
-    "UNH": "United Health Group",
-    "JNJ": "Johnson & Johnson",
-}
-EQUITY_LIST = tuple(EQUITIES.keys())  # List of equity tickers
+# Portfolio holdings as a record array, one contiguous array per field
+EQUITIES_ARR = np.rec.fromrecords(
+    [
+        ("AAPL", "Apple", 75, "buy"),
+        ("MSFT", "Microsoft", 40, "sell"),
+        ("AMZN", "Amazon", 100, "hold"),
+        ("GOOGL", "Alphabet", 50, "hold"),
+        ("TSLA", "Tesla", 40, "hold"),
+        ("BRK-B", "Berkshire Hathaway", 60, "hold"),
+        ("UNH", "United Health Group", 20, "hold"),
+        ("JNJ", "Johnson & Johnson", 40, "hold"),
+    ],
+    names="ticker,company,quantity,action",
+)
+EQUITY_LIST = tuple(EQUITIES_ARR.ticker.tolist())  # List of equity tickers
+
+# Yahoo Finance link of each ticker, built once and shared by every table
+INFO_HTML = tuple(
+    f"<a href='https://finance.yahoo.com/quote/{ticker}' target='_blank'>"
+    f"<div title='Open in Yahoo'>{LINK_SVG}</div></a>"
+    for ticker in EQUITY_LIST
+)
+
+# Local Parquet copy of the CSV, keyed by its URL and reused across restarts until older than the TTL
+CACHE_KEY = hashlib.sha1(CSV_URL.encode()).hexdigest()[:16]
+CACHE_PATH = Path.home() / ".panel_equities" / f"equities-{CACHE_KEY}.parquet"
+CACHE_TTL = 24 * 60 * 60  # Time-to-live of the disk cache in seconds
+
+def read_cached_data(path=CACHE_PATH):
+    """Returns the cached data, or None if it is missing, expired or unreadable"""
+    try:
+        if time.time() - path.stat().st_mtime >= CACHE_TTL:
+            return None
+        return pd.read_parquet(path, engine="pyarrow")
+    except (OSError, ValueError, pa.ArrowException):
+        return None
+
+def write_cached_data(df, path=CACHE_PATH):
+    """Writes the data to the Parquet cache atomically, skipping the disk tier on failure"""
+    tmp_path = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write next to the target and swap it in, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        os.close(fd)
+        df.to_parquet(tmp_path, engine="pyarrow", compression="zstd")
+        os.replace(tmp_path, path)
+    except (OSError, pa.ArrowException):
+        if tmp_path is not None:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
 
 @pn.cache(ttl=600)
 def get_historical_data(tickers=EQUITY_LIST, period="2y"):
-    """Downloads the historical data from Yahoo Finance"""
-    df = pd.read_csv(CSV_URL, index_col=[0, 1], parse_dates=['Date'])
+    """Returns the historical data, from the Parquet cache if fresh, else from the CSV"""
+    df = read_cached_data()
+    if df is not None:
+        return df
+    # Parse the CSV with Arrow's multithreaded reader, then index by ticker and date
+    with urlopen(CSV_URL) as response:
+        table = pac.read_csv(
+            response,
+            convert_options=pac.ConvertOptions(column_types={"Date": pa.timestamp("ns")}),
+        )
+    df = table.to_pandas()
+    df = df.set_index(list(df.columns[:2]))
+    write_cached_data(df)
     return df
 
 # Fetch historical data
 historical_data = get_historical_data()
-historical_data.head(3).round(2)
 
-def last_close(ticker, data=historical_data):
-    """Returns the last close price for the given ticker"""
-    return data.loc[ticker]["Close"].iloc[-1]
-
-# Test fetching the last close price for AAPL
-last_close("AAPL")
-
-# Prepare the summary data dictionary
-summary_data_dict = {
-    "ticker": EQUITY_LIST,
-    "company": EQUITIES.values(),
-    "info": [
-        f"""<a href='https://finance.yahoo.com/quote/{ticker}' target='_blank'>
-        <div title='Open in Yahoo'>{LINK_SVG}</div></a>"""
-        for ticker in EQUITIES
-    ],
-    "quantity": [75, 40, 100, 50, 40, 60, 20, 40],
-    "price": [last_close(ticker) for ticker in EQUITIES],
-    "value": None,
-    "action": ["buy", "sell", "hold", "hold", "hold", "hold", "hold", "hold"],
-    "notes": ["" for i in range(8)],
+# Last close price of every ticker, computed in a single pass over the data
+LAST_CLOSE = historical_data["Close"].groupby(level=0).last()
+
+MAX_CANDLES = 1000  # Upper bound on the number of candles sent to the browser
+
+def downsample_ohlc(data, n_out=MAX_CANDLES):
+    """Merges consecutive rows into at most `n_out` candles, keeping the wick extremes"""
+    if len(data) <= n_out:
+        return data
+    buckets = np.arange(len(data)) * n_out // len(data)
+    return data.groupby(buckets).agg(
+        {"Date": "first", "Open": "first", "High": "max", "Low": "min", "Close": "last"}
+    )
+
+# Prices are shipped to the browser as float32, which is plenty of precision for display
+OHLC_DTYPES = {column: "float32" for column in ("Open", "High", "Low", "Close")}
+
+def prepare_ticker(frame):
+    """Returns the downsampled float32 OHLC frame of a single ticker's rows"""
+    return downsample_ohlc(frame.droplevel(0).reset_index().astype(OHLC_DTYPES))
+
+# Per-ticker OHLC frames, split off in one groupby pass so plotting does not hit the MultiIndex again
+TICKER_FRAMES = {
+    ticker: prepare_ticker(frame)
+    for ticker, frame in historical_data.groupby(level=0)
+    if ticker in EQUITY_LIST
 }
 
-# Convert the summary data dictionary to a DataFrame
-summary_data = pd.DataFrame(summary_data_dict)
+def last_close(ticker, last_closes=LAST_CLOSE):
+    """Returns the last close price for the given ticker"""
+    return last_closes[ticker]
+
+# Prepare the summary data from the holdings, adding the derived columns as vector operations
+summary_data = pd.DataFrame.from_records(EQUITIES_ARR)
+summary_data.insert(2, "info", INFO_HTML)
+summary_data.insert(4, "price", LAST_CLOSE.reindex(EQUITIES_ARR.ticker).to_numpy())
+summary_data["notes"] = ""
 
 def get_value_series(data=summary_data):
-    """Returns the quantity * price series"""
-    return data["quantity"] * data["price"]
+    """Returns the quantity * price array"""
+    return data["quantity"].to_numpy() * data["price"].to_numpy()
 
 # Calculate the value column in the summary data
-summary_data["value"] = get_value_series()
-summary_data.head(2)
+summary_data.insert(5, "value", get_value_series())
+
+# Price and value columns as NumPy arrays, for positional access on the edit path
+PRICE_ARR = summary_data["price"].to_numpy()
+VALUE_ARR = summary_data["value"].to_numpy(copy=True)  # Kept in sync by handle_cell_edit
+
+# Column positions for scalar .iat lookups of the selected row
+TICKER_COL = summary_data.columns.get_loc("ticker")
+COMPANY_COL = summary_data.columns.get_loc("company")
 
 # Define configuration for the summary table columns
 titles = {
@@ -117,6 +205,12 @@ formatters = {
     "price": {"type": "money", "decimal": ".", "thousand": ",", "precision": 2},
     "value": {"type": "money", "decimal": ".", "thousand": ",", "precision": 0},
     "info": {"type": "html", "field": "html"},
+    "action": {
+        "type": "lookup",
+        "buy": "<span class='action-buy'>buy</span>",
+        "sell": "<span class='action-sell'>sell</span>",
+        "hold": "hold",
+    },
 }
 
 text_align = {
@@ -129,6 +223,13 @@ base_configuration = {
     "clipboard": "copy"  # Enable copying data to clipboard
 }
 
+# Cell styles, matched by CSS selectors instead of being computed per cell in Python
+table_stylesheet = f"""
+.action-buy {{ color: {GREEN}; }}
+.action-sell {{ color: {RED}; }}
+.tabulator-cell[tabulator-field="quantity"] {{ background-color: #444; }}
+"""
+
 # Create the summary table widget using Panel's Tabulator
 summary_table = pn.widgets.Tabulator(
     summary_data,
@@ -142,32 +243,56 @@ summary_table = pn.widgets.Tabulator(
     titles=titles,
     widths=widths,
     configuration=base_configuration,
+    stylesheets=[table_stylesheet],
 )
-summary_table
-
-def style_of_action_cell(value, colors={'buy': GREEN, 'sell': RED}):
-    """Returns the css to apply to an 'action' cell depending on the value"""
-    return f'color: {colors[value]}' if value in colors else ''
-
-# Apply the styles to the summary table
-summary_table.style.map(style_of_action_cell, subset=["action"]).set_properties(
-    **{"background-color": "#444"}, subset=["quantity"]
-)
-
 # IntInput widget to track patches
 patches = pn.widgets.IntInput(description="Used to raise an event when a cell value has changed")
 
+EDIT_DEBOUNCE_MS = 300  # Quiet period before pending edits are applied to the table
+# Pending edits and scheduled flushes are tracked per session document, since timeout
+# callbacks belong to the document that scheduled them
+pending_values = {}  # Document -> {row: new market value} waiting for the next flush
+flush_callbacks = {}  # Document -> timeout callback of its scheduled flush, or None
+
+def flush_pending_values(doc=None, table=summary_table):
+    """Applies the pending `value` edits of a session in one patch and raises a single event"""
+    flush_callbacks[doc] = None
+    values = pending_values.pop(doc, None)
+    if not values:
+        return
+    table.patch({"value": list(values.items())})
+    patches.value += 1
+
+def flush_closed_session(doc, session_context):
+    """Applies the pending edits of a closing session instead of dropping them"""
+    flush_pending_values(doc)
+    flush_callbacks.pop(doc, None)
+
 def handle_cell_edit(event, table=summary_table):
-    """Updates the `value` cell when the `quantity` cell is updated"""
+    """Schedules an update of the `value` cell when the `quantity` cell is updated"""
     row = event.row
     column = event.column
     if column == "quantity":
-        quantity = event.value
-        price = summary_table.value.loc[row, "price"]
-        value = quantity * price
-        table.patch({"value": [(row, value)]})
+        VALUE_ARR[row] = event.value * PRICE_ARR[row]
+
+        doc = pn.state.curdoc
+        if doc is not None and doc not in flush_callbacks:
+            doc.on_session_destroyed(partial(flush_closed_session, doc))
+        pending_values.setdefault(doc, {})[row] = VALUE_ARR[row]
+        if doc is None:
+            flush_pending_values(doc, table)
+            return
+        callback = flush_callbacks.get(doc)
+        if callback is not None:
+            # The flush may already have run or been removed with its session
+            with contextlib.suppress(ValueError):
+                doc.remove_timeout_callback(callback)
+        flush_callbacks[doc] = doc.add_timeout_callback(
+            partial(flush_pending_values, doc), EDIT_DEBOUNCE_MS
+        )
 
-        patches.value += 1
+# Layout shared by all candlestick figures
+DARK_LAYOUT = {"template": "plotly_dark", "autosize": True}
 
 # Function to generate candlestick plot
 def candlestick(selection=[], data=summary_data):
@@ -177,11 +302,16 @@ def candlestick(selection=[], data=summary_data):
         company = "Apple"
     else:
         index = selection[0]
-        ticker = data.loc[index, "ticker"]
-        company = data.loc[index, "company"]
+        ticker = data.iat[index, TICKER_COL]
+        company = data.iat[index, COMPANY_COL]
+
+    # Copy the cached figure, since the linked Plotly pane writes zoom and pan state back into it
+    return go.Figure(ticker_figure(ticker, company))
 
-    dff_ticker_hist = historical_data.loc[ticker].reset_index()
-    dff_ticker_hist["Date"] = pd.to_datetime(dff_ticker_hist["Date"])
+@lru_cache(maxsize=len(EQUITY_LIST))
+def ticker_figure(ticker, company):
+    """Returns the candlestick figure of the given ticker, built once per ticker"""
+    dff_ticker_hist = TICKER_FRAMES[ticker]
 
     fig = go.Figure(
         go.Candlestick(
@@ -192,16 +322,9 @@ def candlestick(selection=[], data=summary_data):
             close=dff_ticker_hist["Close"],
         )
     )
-    fig.update_layout(
-        title_text=f"{ticker} {company} Daily Price",
-        template="plotly_dark",
-        autosize=True,
-    )
+    fig.update_layout(title_text=f"{ticker} {company} Daily Price", **DARK_LAYOUT)
     return fig
 
-# Test generating a candlestick plot
-pn.pane.Plotly(candlestick())
-
 # Function to generate portfolio distribution plot
 def portfolio_distribution(patches=0):
     """Returns the distribution of the portfolio"""
@@ -219,20 +342,35 @@ def portfolio_distribution(patches=0):
     fig.layout.autosize = True
     return fig
 
-# Test generating a portfolio distribution plot
-pn.pane.Plotly(portfolio_distribution())
+# Portfolio distribution figure, built once and updated in place after edits
+pie_fig = portfolio_distribution()
+pie_pane = pn.pane.Plotly(pie_fig)
+
+def update_portfolio_distribution(event):
+    """Updates the values and title of the portfolio distribution in place"""
+    portfolio_total = VALUE_ARR.sum()
+    # The pane is linked to the figure, so a batched update reaches it as one message
+    with pie_fig.batch_update():
+        pie_fig.update_traces(values=VALUE_ARR)
+        pie_fig.update_layout(title_text=f"Portfolio Total $ {portfolio_total:,.0f}")
+
+patches.param.watch(update_portfolio_distribution, "value")
 
-# Bind the candlestick and portfolio_distribution functions to be reactive
+# Bind the candlestick function to be reactive
 candlestick = pn.bind(candlestick, selection=summary_table.param.selection)
 summary_table.on_edit(handle_cell_edit)
-portfolio_distribution = pn.bind(portfolio_distribution, patches=patches)
 
 # Create the dashboard layout
-pn.Column(
+dashboard = pn.Column(
     pn.Row(
         pn.pane.Plotly(candlestick), 
-        pn.pane.Plotly(portfolio_distribution)
+        pie_pane
     ),
     summary_table,
     height=600
-).servable()
+)
+dashboard.servable()
+
+# Serve directly with `python panel_code.py`; `panel serve panel_code.py` uses the servable above
+if __name__ == "__main__":
+    pn.serve(dashboard, port=5006, **SERVE_OPTIONS)